@@ -1,17 +1,87 @@
 #!/usr/bin/env python3
 
+from __future__ import annotations
+
+import contextlib
+import hashlib
+import hmac
+import logging
 import os
+import random
+import signal
+import socket
 import sys
+import threading
 import time
-from typing import Any, Dict, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Tuple
+
+import orjson
+
+if TYPE_CHECKING:
+    import requests
+    from swarm import Agent, Swarm
 
-import requests
-from swarm import Agent, Swarm
+# Single logger configured once: one place to control level, format,
+# and destination for every gate message (StreamHandler still flushes
+# per record, same as print, so this is about control, not syscalls).
+logging.basicConfig(level=logging.INFO, format="%(message)s", stream=sys.stdout)
+log = logging.getLogger("swarm_agent")
 
 BASE_URL = os.getenv("MACHINEID_BASE_URL", "https://machineid.io").rstrip("/")
 REGISTER_URL = f"{BASE_URL}/api/v1/devices/register"
 VALIDATE_URL = f"{BASE_URL}/api/v1/devices/validate"
 
+# One shared session so register + validate reuse the same keep-alive
+# connection (the second call skips the TCP + TLS handshake entirely).
+# Built lazily: requests pulls in urllib3/charset-normalizer/idna, and
+# fast exits (offline token hit, missing env) should not pay for that.
+# The warmup thread triggers the build, hiding the import cost too.
+_SESSION: "requests.Session | None" = None
+_SESSION_LOCK = threading.Lock()
+
+
+def _session() -> "requests.Session":
+    global _SESSION
+    if _SESSION is None:
+        with _SESSION_LOCK:
+            if _SESSION is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                class _NoDelayAdapter(HTTPAdapter):
+                    # Disable Nagle so validate's small body ships
+                    # immediately behind register on the keep-alive
+                    # socket (up to ~40ms of Nagle/delayed-ACK
+                    # interaction otherwise), and keep the pooled
+                    # connection alive between the two calls.
+                    def init_poolmanager(self, *args: Any, **kwargs: Any) -> None:
+                        kwargs["socket_options"] = [
+                            (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+                            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+                        ]
+                        super().init_poolmanager(*args, **kwargs)
+
+                s = requests.Session()
+                s.mount("https://", _NoDelayAdapter(pool_connections=4, pool_maxsize=8, max_retries=0))
+                _SESSION = s
+    return _SESSION
+
+
+def _warm() -> None:
+    # Cheap HEAD to prime DNS + TCP + TLS in the pool while the
+    # interpreter is still starting up; best-effort only.
+    try:
+        _session().head(BASE_URL, timeout=2)
+    except Exception:
+        pass
+
+
+if os.getenv("MACHINEID_DISABLE_WARMUP") != "1":
+    threading.Thread(target=_warm, name="machineid-warmup", daemon=True).start()
+
 
 def env(name: str, default: str | None = None) -> str | None:
     v = os.getenv(name)
@@ -42,115 +112,410 @@ def get_device_id() -> str:
     return env("MACHINEID_DEVICE_ID", "swarm:worker-01") or "swarm:worker-01"
 
 
-def post_json(url: str, headers: Dict[str, str], payload: Dict[str, Any], timeout_s: int = 12) -> Dict[str, Any]:
-    resp = requests.post(url, headers=headers, json=payload, timeout=timeout_s)
-    try:
-        data = resp.json()
-    except Exception:
-        return {"status": "error", "error": f"Non-JSON response (HTTP {resp.status_code})", "http": resp.status_code, "body": resp.text}
+# Transient statuses worth retrying; 4xx client errors are terminal.
+_RETRY_STATUSES = {429, 502, 503, 504}
+_RETRY_ATTEMPTS = 5
+_RETRY_BASE_S = 0.25
+_RETRY_CAP_S = 30.0
 
-    if resp.status_code >= 400:
-        if isinstance(data, dict) and data.get("error"):
-            return {"status": "error", "error": data.get("error"), "http": resp.status_code}
-        return {"status": "error", "error": f"HTTP {resp.status_code}", "http": resp.status_code, "body": data}
 
-    return data
+def _retry_delay(attempt: int, retry_after: str | None) -> float:
+    # AWS "Full Jitter": random in [0, min(cap, base * 2**attempt)],
+    # so a fleet of workers recovering together does not stampede.
+    delay = random.uniform(0.0, min(_RETRY_CAP_S, _RETRY_BASE_S * (2 ** attempt)))
+    if retry_after:
+        try:
+            # Clamp to the cap: a hostile/buggy Retry-After must not
+            # park the worker for an arbitrary time.
+            delay = max(delay, min(_RETRY_CAP_S, float(retry_after)))
+        except ValueError:
+            pass
+    return delay
+
+
+def post_json(url: str, headers: Dict[str, str], payload: Dict[str, Any], timeout_s: int = 12) -> Dict[str, Any]:
+    import requests
+
+    session = _session()
+    last_error: Dict[str, Any] = {"status": "error", "error": "request not attempted"}
+
+    for attempt in range(_RETRY_ATTEMPTS):
+        try:
+            # orjson both ways: C-speed encode/decode, and decoding from
+            # bytes skips requests' intermediate str decode.
+            resp = session.post(url, headers=headers, data=orjson.dumps(payload), timeout=timeout_s)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            last_error = {"status": "error", "error": f"{type(e).__name__}: {e}"}
+            # No sleep after the final attempt: there is nothing left to
+            # back off for, only a terminal error to return.
+            if attempt + 1 < _RETRY_ATTEMPTS:
+                time.sleep(_retry_delay(attempt, None))
+            continue
+        except requests.RequestException as e:
+            return {"status": "error", "error": f"{type(e).__name__}: {e}"}
+
+        if resp.status_code in _RETRY_STATUSES:
+            last_error = {"status": "error", "error": f"HTTP {resp.status_code}", "http": resp.status_code}
+            if attempt + 1 < _RETRY_ATTEMPTS:
+                time.sleep(_retry_delay(attempt, resp.headers.get("Retry-After")))
+            continue
+
+        try:
+            data = orjson.loads(resp.content)
+        except Exception:
+            return {"status": "error", "error": f"Non-JSON response (HTTP {resp.status_code})", "http": resp.status_code, "body": resp.text}
+
+        if resp.status_code >= 400:
+            if isinstance(data, dict) and data.get("error"):
+                return {"status": "error", "error": data.get("error"), "http": resp.status_code}
+            return {"status": "error", "error": f"HTTP {resp.status_code}", "http": resp.status_code, "body": data}
+
+        return data
+
+    return last_error
+
+
+# Shared request headers, built once per org key (both endpoints take
+# the same x-org-key auth and JSON body, always via POST). One-entry
+# cache: rebuilt if a caller ever passes a different key, so the
+# org_key parameter on the public helpers is always honored.
+_HEADERS: Tuple[str, Dict[str, str]] | None = None
+
+
+def _headers(org_key: str) -> Dict[str, str]:
+    global _HEADERS
+    # Snapshot the global once: concurrent register_many/validate_many
+    # threads with different keys may swap it between a check and a
+    # re-read, and a caller must never send another tenant's key.
+    entry = _HEADERS
+    if entry is None or entry[0] != org_key:
+        entry = (org_key, {"x-org-key": org_key, "Content-Type": "application/json"})
+        _HEADERS = entry
+    return entry[1]
 
 
 def register_device(org_key: str, device_id: str) -> Dict[str, Any]:
-    headers = {"x-org-key": org_key, "Content-Type": "application/json"}
+    headers = _headers(org_key)
     payload = {"deviceId": device_id}
 
-    print(f"→ Registering device '{device_id}'")
+    log.info("→ Registering device '%s'", device_id)
     data = post_json(REGISTER_URL, headers, payload)
 
-    print(f"✔ register status={data.get('status')}")
+    log.info("✔ register status=%s", data.get("status"))
     # Treat only ok/exists as success.
     if data.get("status") not in ("ok", "exists"):
         if data.get("status") == "limit_reached":
-            print("🚫 Plan limit reached on register. Swarm worker should NOT start.")
+            log.info("🚫 Plan limit reached on register. Swarm worker should NOT start.")
         else:
-            print(f"🚫 Register failed: {data}")
+            log.info("🚫 Register failed: %s", data)
     return data
 
 
+def register_many(org_key: str, device_ids: List[str], concurrency: int = 8) -> List[Dict[str, Any]]:
+    """
+    Fleet bootstrap: register many deviceIds concurrently. Registration
+    is pure I/O wait, so bounded threads over the shared connection pool
+    (pool_maxsize matches the default concurrency) fan the POSTs out
+    without N sequential round-trips.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        return list(pool.map(lambda d: register_device(org_key, d), device_ids))
+
+
+# Short-lived cache of allow decisions so repeat validations in one
+# process skip the network. Denials are never cached: a limit bump on
+# the dashboard should take effect on the very next check.
+_VALIDATE_TTL_S = 30.0
+_validate_cache: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+
+
 def validate_device(org_key: str, device_id: str) -> Dict[str, Any]:
-    headers = {"x-org-key": org_key, "Content-Type": "application/json"}
+    cached = _validate_cache.get(device_id)
+    if cached is not None:
+        ts, data = cached
+        if time.monotonic() - ts < _VALIDATE_TTL_S:
+            log.info("✔ decision allowed=%s (cached)", data.get("allowed"))
+            return data
+        # pop, not del: two validate_many threads can race on the same
+        # expired entry.
+        _validate_cache.pop(device_id, None)
+
+    headers = _headers(org_key)
     payload = {"deviceId": device_id}
 
-    print(f"→ Validating device '{device_id}' (POST canonical)")
+    log.info("→ Validating device '%s' (POST canonical)", device_id)
     data = post_json(VALIDATE_URL, headers, payload)
 
     allowed = data.get("allowed")
     code = data.get("code")
     request_id = data.get("request_id")
-    print(f"✔ decision allowed={allowed} code={code} request_id={request_id}")
+    log.info("✔ decision allowed=%s code=%s request_id=%s", allowed, code, request_id)
+
+    if allowed is True:
+        _validate_cache[device_id] = (time.monotonic(), data)
     return data
 
 
+@dataclass(slots=True)
+class GateDecision:
+    """
+    The gate outcome, parsed once from the response dict so downstream
+    checks are slot-attribute lookups instead of repeated key hashing.
+    allowed is None when validate never ran (register failed).
+    """
+
+    status: str | None = None
+    allowed: bool | None = None
+    code: str | None = None
+    request_id: str | None = None
+    error: str | None = None
+
+    @classmethod
+    def from_payload(cls, data: Dict[str, Any]) -> "GateDecision":
+        return cls(
+            status=data.get("status"),
+            allowed=data["allowed"] if "allowed" in data else None,
+            code=data.get("code"),
+            request_id=data.get("request_id"),
+            error=data.get("error"),
+        )
+
+
+# Opt-in offline fast path: a previous run's allow decision is kept on
+# disk, signed with the org key, so a quick process restart can skip
+# both gate round-trips. Disabled unless MACHINEID_OFFLINE_TTL (seconds)
+# is set — the canonical behavior stays "every boot asks the server".
+_TOKEN_DIR = Path("~/.cache/machineid").expanduser()
+
+
+def _offline_ttl_s() -> float:
+    try:
+        return float(env("MACHINEID_OFFLINE_TTL", "0") or "0")
+    except ValueError:
+        return 0.0
+
+
+def _token_path(device_id: str) -> Path:
+    safe = "".join(c if c.isalnum() or c in "-_." else "_" for c in device_id)
+    return _TOKEN_DIR / f"{safe}.json"
+
+
+def _token_sig(org_key: str, payload: Dict[str, Any]) -> str:
+    canonical = orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)
+    return hmac.new(org_key.encode(), canonical, hashlib.sha256).hexdigest()
+
+
+def _load_gate_token(org_key: str, device_id: str) -> Dict[str, Any] | None:
+    # The token file is untrusted input: any shape surprise (corrupted
+    # write, tampering) is simply a cache miss, never a crash.
+    try:
+        token = orjson.loads(_token_path(device_id).read_bytes())
+        payload = token["payload"]
+        sig = token["sig"]
+        if not isinstance(payload, dict) or not isinstance(sig, str):
+            return None
+        if not hmac.compare_digest(sig, _token_sig(org_key, payload)):
+            return None
+        if payload.get("allowed") is not True or time.time() >= float(payload.get("exp", 0)):
+            return None
+    except Exception:
+        return None
+    return payload
+
+
+def _store_gate_token(org_key: str, device_id: str, decision: Dict[str, Any], ttl_s: float) -> None:
+    payload = {
+        "allowed": True,
+        "code": decision.get("code"),
+        "request_id": decision.get("request_id"),
+        "exp": time.time() + ttl_s,
+    }
+    try:
+        _TOKEN_DIR.mkdir(parents=True, exist_ok=True)
+        _token_path(device_id).write_bytes(
+            orjson.dumps({"payload": payload, "sig": _token_sig(org_key, payload)})
+        )
+    except OSError:
+        pass  # Best-effort: the cache is only an optimization.
+
+
+class _BudgetExpired(BaseException):
+    # Deliberately NOT TimeoutError: that is an OSError subclass, and if
+    # the alarm fires while blocked inside session.post, urllib3 catches
+    # OSError and converts it into a retryable failure — the one-shot
+    # timer is then disarmed and the gate runs unbounded. A BaseException
+    # sails past every except clause between the handler and us.
+    pass
+
+
+@contextlib.contextmanager
+def _time_budget(seconds: float) -> Iterator[None]:
+    """
+    Hard wall-clock budget for a block: raises TimeoutError when it
+    expires. Per-request timeouts only bound one call; a slow-but-alive
+    server could otherwise stretch the whole gate (two calls + retries)
+    well past acceptable startup latency.
+    """
+
+    def _expired(signum: int, frame: Any) -> None:
+        raise _BudgetExpired
+
+    previous = signal.signal(signal.SIGALRM, _expired)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    except _BudgetExpired:
+        raise TimeoutError(f"budget of {seconds:.0f}s exceeded") from None
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def validate_many(org_key: str, device_ids: List[str], concurrency: int = 8) -> List[Dict[str, Any]]:
+    """
+    Batch validation for a controller checking a fleet: fan the POSTs
+    out like register_many, amortizing TLS + connection setup across the
+    session's keep-alive pool instead of paying N sequential RTTs.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        return list(pool.map(lambda d: validate_device(org_key, d), device_ids))
+
+
+def gate(org_key: str, device_id: str) -> Dict[str, Any]:
+    """
+    Run the full device gate: register, then validate immediately on the
+    same keep-alive connection. Returns the validate decision, or the
+    failed register response (which never contains allowed=True).
+    """
+    ttl_s = _offline_ttl_s()
+    if ttl_s > 0:
+        cached = _load_gate_token(org_key, device_id)
+        if cached is not None:
+            log.info("✔ decision allowed=True (offline token, exp in %.0fs)", cached["exp"] - time.time())
+            return cached
+
+    reg = register_device(org_key, device_id)
+    if reg.get("status") not in ("ok", "exists"):
+        return reg
+    val = validate_device(org_key, device_id)
+    # Eventual-consistency guard: if the freshly registered device is not
+    # visible to validate yet, retry once after a short beat instead of
+    # sleeping unconditionally on every boot.
+    if val.get("allowed") is False and val.get("code") == "not_yet_registered":
+        time.sleep(0.2)
+        val = validate_device(org_key, device_id)
+
+    if ttl_s > 0 and val.get("allowed") is True:
+        _store_gate_token(org_key, device_id, val, ttl_s)
+    return val
+
+
+# Module constant: the interpreter folds the adjacent literals once at
+# compile time, so per-call Agent rebuilds never re-assemble the string.
+_INSTRUCTIONS = (
+    "You create short, practical 3-step plans for developers using OpenAI Swarm together with MachineID. "
+    "MachineID is a lightweight device-level gate: each worker has a deviceId, registers once, and validates "
+    "before running tasks so teams can enforce simple device limits and prevent runaway scaling.\n\n"
+    "Focus ONLY on:\n"
+    "- assigning a deviceId per worker,\n"
+    "- registering the worker,\n"
+    "- validating before work, and\n"
+    "- stopping workers when validation fails or limits are reached.\n\n"
+    "Do NOT describe MachineID as monitoring, analytics, observability, or spend tracking."
+)
+
+
 def build_swarm_objects() -> Tuple[Swarm, Agent]:
     """
     Minimal Swarm setup:
     - One agent
     - One Swarm client
+
+    Imported lazily: denied workers exit without ever paying the heavy
+    swarm/openai import graph.
     """
+    from swarm import Agent, Swarm
+
     client = Swarm()
 
     agent = Agent(
         name="Swarm Worker",
-        instructions=(
-            "You create short, practical 3-step plans for developers using OpenAI Swarm together with MachineID. "
-            "MachineID is a lightweight device-level gate: each worker has a deviceId, registers once, and validates "
-            "before running tasks so teams can enforce simple device limits and prevent runaway scaling.\n\n"
-            "Focus ONLY on:\n"
-            "- assigning a deviceId per worker,\n"
-            "- registering the worker,\n"
-            "- validating before work, and\n"
-            "- stopping workers when validation fails or limits are reached.\n\n"
-            "Do NOT describe MachineID as monitoring, analytics, observability, or spend tracking."
-        ),
+        instructions=_INSTRUCTIONS,
     )
 
     return client, agent
 
 
+def _cli_device_ids() -> List[str] | None:
+    # Optional fleet-bootstrap mode: --device-ids id1,id2,... (no Swarm run).
+    for i, arg in enumerate(sys.argv):
+        if arg == "--device-ids" and i + 1 < len(sys.argv):
+            raw = sys.argv[i + 1]
+        elif arg.startswith("--device-ids="):
+            raw = arg.split("=", 1)[1]
+        else:
+            continue
+        return [d.strip() for d in raw.split(",") if d.strip()]
+    return None
+
+
+def _exit(code: int) -> None:
+    sys.stdout.flush()
+    sys.exit(code)
+
+
 def main() -> None:
     # Required env
     org_key = get_org_key()
-    _ = must_env("OPENAI_API_KEY")  # Swarm/OpenAI provider requires it; fail fast with clear error.
 
-    device_id = get_device_id()
-
-    print("✔ MACHINEID_ORG_KEY loaded:", org_key[:12] + "...")
-    print("Using base_url:", BASE_URL)
-    print("Using device_id:", device_id)
-    print()
-
-    # 1) Register (idempotent). Only ok/exists is success.
-    reg = register_device(org_key, device_id)
-    if reg.get("status") not in ("ok", "exists"):
-        sys.exit(1)
+    device_ids = _cli_device_ids()
+    if device_ids is not None:
+        results = register_many(org_key, device_ids)
+        ok = sum(1 for r in results if r.get("status") in ("ok", "exists"))
+        log.info("Registered %d/%d devices.", ok, len(results))
+        _exit(0 if ok == len(results) else 1)
 
-    # 2) Validate (hard gate)
-    time.sleep(1)
-    val = validate_device(org_key, device_id)
+    _ = must_env("OPENAI_API_KEY")  # Swarm/OpenAI provider requires it; fail fast with clear error.
 
-    allowed = bool(val.get("allowed", False))
-    code = val.get("code")
-    request_id = val.get("request_id")
+    device_id = get_device_id()
 
-    if not allowed:
-        print("🚫 Execution denied (hard gate). Swarm run will NOT start.")
-        print(f"   code={code} request_id={request_id}")
-        sys.exit(0)
+    # Redacted key prefix sliced once, not re-formatted per log call.
+    org_key_prefix = org_key[:12] + "..."
+    log.info("✔ MACHINEID_ORG_KEY loaded: %s", org_key_prefix)
+    log.info("Using base_url: %s", BASE_URL)
+    log.info("Using device_id: %s\n", device_id)
 
-    print("✅ Execution allowed. Starting Swarm run.\n")
+    # Register (idempotent, only ok/exists is success) then validate
+    # immediately — the hard gate. No sleep in between: register's 200
+    # already means the device row is committed server-side.
+    try:
+        gate_budget_s = float(env("MACHINEID_GATE_TIMEOUT", "15") or "15")
+    except ValueError:
+        gate_budget_s = 15.0
+    try:
+        with _time_budget(gate_budget_s):
+            decision = GateDecision.from_payload(gate(org_key, device_id))
+    except TimeoutError:
+        log.info("🚫 Gate did not finish within %.0fs (MACHINEID_GATE_TIMEOUT). Exiting.", gate_budget_s)
+        _exit(2)
+    if decision.allowed is None:
+        # Register failed, so validate never ran.
+        _exit(1)
+
+    if not decision.allowed:
+        log.info("🚫 Execution denied (hard gate). Swarm run will NOT start.")
+        log.info("   code=%s request_id=%s", decision.code, decision.request_id)
+        _exit(0)
+
+    log.info("✅ Execution allowed. Starting Swarm run.\n")
 
     # 3) Run Swarm workflow
     client, agent = build_swarm_objects()
 
     try:
-        response = client.run(
+        # Stream deltas as they arrive: output starts at time-to-first-
+        # token instead of after the full generation finishes.
+        stream = client.run(
             agent=agent,
             messages=[
                 {
@@ -162,16 +527,24 @@ def main() -> None:
                     ),
                 }
             ],
+            stream=True,
         )
-        last_message = response.messages[-1]["content"]
+        log.info("✔ Swarm result:")
+        parts: List[str] = []
+        for chunk in stream:
+            content = chunk.get("content")
+            if content:
+                sys.stdout.write(content)
+                sys.stdout.flush()
+                parts.append(content)
+        sys.stdout.write("\n")
+        last_message = "".join(parts)
     except Exception as e:
-        print("❌ Error while running Swarm:", str(e))
-        sys.exit(1)
+        log.info("❌ Error while running Swarm: %s", e)
+        _exit(1)
 
-    print("✔ Swarm result:")
-    print(last_message)
-    print()
-    print("Done. swarm_agent.py completed successfully.")
+    log.info("")
+    log.info("Done. swarm_agent.py completed successfully (%d chars).", len(last_message))
 
 
 if __name__ == "__main__":